@@ -3,8 +3,17 @@ import numpy as np
 import cv2
 import tensorflow as tf
 import base64
+import collections
+import io
+import itertools
+import os
+import re
+import tempfile
+import threading
 from datetime import datetime
 import json
+import mimetypes
+from PIL import Image
 
 # Page configuration
 st.set_page_config(
@@ -15,59 +24,65 @@ st.set_page_config(
 )
 
 # Initialize session state
+# Packed per-record grades; 'total' = icm + te + exp so quality buckets are exact integer tests
+HISTORY_DTYPE = np.dtype([('icm', 'i1'), ('te', 'i1'), ('exp', 'i1'), ('total', 'i1')])
+MAX_HISTORY = 100
+HISTORY_PAGE_SIZE = 20
+
 if 'history' not in st.session_state:
-    st.session_state.history = []
+    st.session_state.history = collections.deque(maxlen=MAX_HISTORY)
+if 'history_arr' not in st.session_state:
+    st.session_state.history_arr = np.empty(0, dtype=HISTORY_DTYPE)
 
 IMG_SIZE = 224
+PREVIEW_SIZE = 512
+MODEL_PATH = "embryo_output_model.keras"
+TFLITE_PATH = "embryo_grades_u8_f32_v2.tflite"
 
 #------------Functions------------
-def get_inference(icm, te, exp):
-    notes = []
-    if icm >= 4:
-        notes.append("🟢 **ICM:** Good inner cell mass – likely healthy embryoblast.")
-    elif icm == 3:
-        notes.append("🟡 **ICM:** Moderate ICM – acceptable but not ideal.")
-    else:
-        notes.append("🔴 **ICM:** Poor ICM – lower likelihood of successful implantation.")
+# Star rating bars indexed by grade (0-5)
+STAR_BAR = tuple('⭐' * i + '☆' * (5 - i) for i in range(6))
+STARS = tuple('⭐' * i for i in range(6))
 
-    if te >= 4:
-        notes.append("🟢 **TE:** Strong trophectoderm – better implantation probability.")
-    elif te == 3:
-        notes.append("🟡 **TE:** Average TE – may still be viable.")
-    else:
-        notes.append("🔴 **TE:** Weak TE – may reduce implantation chances.")
+# Lookup tables indexed by grade (0-5); grades 0-2 share the "poor" entry
+_ICM_POOR = "🔴 **ICM:** Poor ICM – lower likelihood of successful implantation."
+_ICM_MODERATE = "🟡 **ICM:** Moderate ICM – acceptable but not ideal."
+_ICM_GOOD = "🟢 **ICM:** Good inner cell mass – likely healthy embryoblast."
+ICM_NOTES = (_ICM_POOR, _ICM_POOR, _ICM_POOR, _ICM_MODERATE, _ICM_GOOD, _ICM_GOOD)
 
-    if exp >= 4:
-        notes.append("🟢 **Expansion:** Well-expanded blastocyst – good development.")
-    elif exp == 3:
-        notes.append("🟡 **Expansion:** Moderate expansion – monitor carefully.")
-    else:
-        notes.append("🔴 **Expansion:** Poor expansion – embryo may be underdeveloped.")
-
-    if icm >= 4 and te >= 4 and exp >= 4:
-        summary = "✅ **Overall:** High-quality blastocyst – strong transfer candidate."
-        quality_level = "Excellent"
-    elif icm >= 3 and te >= 3 and exp >= 3:
-        summary = "⚠️ **Overall:** Medium-quality embryo – possible, but requires clinical judgement."
-        quality_level = "Moderate"
-    else:
-        summary = "❌ **Overall:** Low-quality blastocyst – poor prognosis."
-        quality_level = "Poor"
+_TE_POOR = "🔴 **TE:** Weak TE – may reduce implantation chances."
+_TE_MODERATE = "🟡 **TE:** Average TE – may still be viable."
+_TE_GOOD = "🟢 **TE:** Strong trophectoderm – better implantation probability."
+TE_NOTES = (_TE_POOR, _TE_POOR, _TE_POOR, _TE_MODERATE, _TE_GOOD, _TE_GOOD)
+
+_EXP_POOR = "🔴 **Expansion:** Poor expansion – embryo may be underdeveloped."
+_EXP_MODERATE = "🟡 **Expansion:** Moderate expansion – monitor carefully."
+_EXP_GOOD = "🟢 **Expansion:** Well-expanded blastocyst – good development."
+EXP_NOTES = (_EXP_POOR, _EXP_POOR, _EXP_POOR, _EXP_MODERATE, _EXP_GOOD, _EXP_GOOD)
+
+_SUMMARY_POOR = ("❌ **Overall:** Low-quality blastocyst – poor prognosis.", "Poor")
+_SUMMARY_MODERATE = ("⚠️ **Overall:** Medium-quality embryo – possible, but requires clinical judgement.", "Moderate")
+_SUMMARY_EXCELLENT = ("✅ **Overall:** High-quality blastocyst – strong transfer candidate.", "Excellent")
+SUMMARIES = (_SUMMARY_POOR, _SUMMARY_POOR, _SUMMARY_POOR, _SUMMARY_MODERATE, _SUMMARY_EXCELLENT, _SUMMARY_EXCELLENT)
+
+
+def _compute_inference(icm, te, exp):
+    notes = (ICM_NOTES[min(icm, 5)], TE_NOTES[min(te, 5)], EXP_NOTES[min(exp, 5)])
+    summary, quality_level = SUMMARIES[min(icm, te, exp, 5)]
 
     return summary, notes, quality_level
 
 
-def get_clinical_recommendations(icm, te, exp):
+def _recommendations(bucket, low_icm, low_te, low_exp):
     recommendations = []
-    avg_score = (icm + te + exp) / 3
     
     recommendations.append("### 🎯 Transfer Recommendations")
-    if avg_score >= 4:
+    if bucket == 2:
         recommendations.append("- **Priority Candidate:** This embryo shows excellent quality indicators")
         recommendations.append("- **Transfer Strategy:** Suitable for single embryo transfer (SET)")
         recommendations.append("- **Success Rate:** High probability of successful implantation (60-70%)")
         recommendations.append("- **Timing:** Optimal for fresh transfer or vitrification")
-    elif avg_score >= 3:
+    elif bucket == 1:
         recommendations.append("- **Viable Candidate:** This embryo shows moderate quality")
         recommendations.append("- **Transfer Strategy:** Consider patient age and history")
         recommendations.append("- **Success Rate:** Moderate probability of implantation (40-50%)")
@@ -80,19 +95,19 @@ def get_clinical_recommendations(icm, te, exp):
     
     recommendations.append("\n### 🔬 Parameter-Specific Guidance")
     
-    if icm < 3:
+    if low_icm:
         recommendations.append("**ICM Concerns:**")
         recommendations.append("- Review culture media composition and oxygen levels")
         recommendations.append("- Consider growth factor supplementation")
         recommendations.append("- Evaluate oocyte quality in future cycles")
     
-    if te < 3:
+    if low_te:
         recommendations.append("**TE Concerns:**")
         recommendations.append("- Potential implantation challenges expected")
         recommendations.append("- Consider assisted hatching if transfer proceeds")
         recommendations.append("- Optimize luteal phase progesterone support")
     
-    if exp < 3:
+    if low_exp:
         recommendations.append("**Expansion Concerns:**")
         recommendations.append("- Embryo may benefit from additional 12-24 hours culture")
         recommendations.append("- Assess zona pellucida thickness")
@@ -103,10 +118,16 @@ def get_clinical_recommendations(icm, te, exp):
     recommendations.append("- Discuss realistic expectations with patient")
     recommendations.append("- Consider PGT-A testing for future embryos if indicated")
     
-    return recommendations
+    return tuple(recommendations)
 
 
-def calculate_success_metrics(icm, te, exp):
+def _compute_recommendations(icm, te, exp):
+    avg_score = (icm + te + exp) / 3
+    bucket = 2 if avg_score >= 4 else 1 if avg_score >= 3 else 0
+    return _recommendations(bucket, icm < 3, te < 3, exp < 3)
+
+
+def _compute_success_metrics(icm, te, exp):
     avg_score = (icm + te + exp) / 3
     base_prob = (icm * 0.35 + te * 0.40 + exp * 0.25) / 5 * 100
     
@@ -132,92 +153,179 @@ def calculate_success_metrics(icm, te, exp):
     }
 
 
-def generate_text_report(icm, te, exp, patient_data):
-    report_lines = []
-    timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
-    
-    report_lines.append("=" * 80)
-    report_lines.append("BLASTOCYST GRADING REPORT".center(80))
-    report_lines.append("AI-Powered Embryo Quality Assessment".center(80))
-    report_lines.append("=" * 80)
-    report_lines.append("")
-    report_lines.append(f"Report Generated: {timestamp}")
-    report_lines.append(f"Report ID: {datetime.now().strftime('%Y%m%d-%H%M%S')}")
-    report_lines.append("System Version: v2.0")
-    report_lines.append("")
-    report_lines.append("-" * 80)
-    report_lines.append("PATIENT & EMBRYO INFORMATION")
-    report_lines.append("-" * 80)
-    
-    for key, value in patient_data.items():
-        if value and value != "N/A":
-            report_lines.append(f"{key}: {value}")
-    
-    report_lines.append("")
-    report_lines.append("-" * 80)
-    report_lines.append("GRADING RESULTS")
-    report_lines.append("-" * 80)
-    
+# Every (icm, te, exp) combination, built once per process and shared across reruns
+@st.cache_resource
+def _grade_tables():
+    keys = list(itertools.product(range(1, 6), repeat=3))
+    return (
+        {k: _compute_inference(*k) for k in keys},
+        {k: _compute_recommendations(*k) for k in keys},
+        {k: _compute_success_metrics(*k) for k in keys},
+    )
+
+_INFERENCE, _RECOMMENDATIONS, _METRICS = _grade_tables()
+
+
+def get_inference(icm, te, exp):
+    return _INFERENCE.get((icm, te, exp)) or _compute_inference(icm, te, exp)
+
+
+def get_clinical_recommendations(icm, te, exp):
+    return _RECOMMENDATIONS.get((icm, te, exp)) or _compute_recommendations(icm, te, exp)
+
+
+def calculate_success_metrics(icm, te, exp):
+    return _METRICS.get((icm, te, exp)) or _compute_success_metrics(icm, te, exp)
+
+
+_RULE = "-" * 80
+_DOUBLE_RULE = "=" * 80
+
+REPORT_HEADER = "\n".join([
+    _DOUBLE_RULE,
+    "BLASTOCYST GRADING REPORT".center(80),
+    "AI-Powered Embryo Quality Assessment".center(80),
+    _DOUBLE_RULE,
+    "",
+])
+
+REPORT_FOOTER = "\n".join([
+    "",
+    _RULE,
+    "GRADING CRITERIA REFERENCE",
+    _RULE,
+    "",
+    "Inner Cell Mass (ICM): Grade 5 (Excellent) to Grade 1 (Poor)",
+    "Trophectoderm (TE): Grade 5 (Excellent) to Grade 1 (Poor)",
+    "Expansion (EXP): Grade 5 (Hatching) to Grade 1 (Early)",
+    "",
+    _DOUBLE_RULE,
+    "DISCLAIMER: AI-assisted analysis. Requires professional validation.",
+    _DOUBLE_RULE,
+])
+
+
+# Markdown/emoji stripping for the plain-text report
+_SUMMARY_TRANS = str.maketrans("", "", "*✅⚠\ufe0f❌")
+_NOTE_TRANS = str.maketrans({"*": None, "🟢": "[GOOD]", "🟡": "[MODERATE]", "🔴": "[POOR]"})
+_REC_TRANS = str.maketrans("", "", "#*🎯🔬📋")
+
+# Markdown bold is not rendered inside raw HTML blocks
+_MD_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+
+
+def md_bold_to_html(text):
+    return _MD_BOLD_RE.sub(r"<b>\1</b>", text)
+
+
+@st.cache_data(show_spinner=False, max_entries=125)
+def analysis_notes_html(icm, te, exp):
+    notes = get_inference(icm, te, exp)[1]
+    return "".join(f"<div class='analysis-note'>{md_bold_to_html(note)}</div>" for note in notes)
+
+
+@st.cache_data(show_spinner=False, max_entries=125)
+def recommendation_html(icm, te, exp):
+    parts = ["<div class='recommendation-box'>"]
+    for rec in get_clinical_recommendations(icm, te, exp):
+        rec = rec.strip()
+        if rec.startswith('###'):
+            clean_heading = rec.replace('###', '').strip()
+            parts.append(f"<h4 style='color: #1F3C88; font-size: 18px; font-weight: 700; margin-top: 15px;'>{clean_heading}</h4>")
+        else:
+            parts.append(f"<p style='color: #2c3e50; font-size: 15px; line-height: 1.8; margin: 8px 0;'>{md_bold_to_html(rec)}</p>")
+    parts.append("</div>")
+    return "".join(parts)
+
+
+def _section(title):
+    return f"{_RULE}\n{title}\n{_RULE}"
+
+PATIENT_SECTION = _section("PATIENT & EMBRYO INFORMATION")
+GRADING_SECTION = _section("GRADING RESULTS")
+ANALYSIS_SECTION = _section("CLINICAL ANALYSIS")
+RECOMMENDATIONS_SECTION = _section("CLINICAL RECOMMENDATIONS")
+
+
+def _patient_section(patient_data):
+    return [
+        PATIENT_SECTION,
+        *(f"{key}: {value}" for key, value in patient_data.items() if value is not None),
+    ]
+
+
+@st.cache_data(show_spinner=False, max_entries=125)
+def _results_section(icm, te, exp):
+    # Grading, analysis and recommendations depend only on the grades
     metrics = calculate_success_metrics(icm, te, exp)
-    
-    report_lines.append(f"Inner Cell Mass (ICM): {icm}/5 {'⭐' * icm}{'☆' * (5-icm)}")
-    report_lines.append(f"Trophectoderm (TE): {te}/5 {'⭐' * te}{'☆' * (5-te)}")
-    report_lines.append(f"Expansion Grade (EXP): {exp}/5 {'⭐' * exp}{'☆' * (5-exp)}")
-    report_lines.append("")
-    report_lines.append(f"Quality Score: {metrics['quality_score']}")
-    report_lines.append(f"Success Probability: {metrics['success_probability']}")
-    report_lines.append(f"Development Stage: {metrics['development_stage']}")
-    report_lines.append(f"Transfer Priority: {metrics['transfer_priority']}")
-    report_lines.append("")
-    
-    report_lines.append("-" * 80)
-    report_lines.append("CLINICAL ANALYSIS")
-    report_lines.append("-" * 80)
-    
-    summary, notes, quality_level = get_inference(icm, te, exp)
-    clean_summary = summary.replace('**', '').replace('✅', '').replace('⚠️', '').replace('❌', '')
-    report_lines.append(clean_summary)
-    report_lines.append("")
-    
-    for note in notes:
-        clean_note = note.replace('**', '').replace('🟢', '[GOOD]').replace('🟡', '[MODERATE]').replace('🔴', '[POOR]')
-        report_lines.append(clean_note)
-    
-    report_lines.append("")
-    report_lines.append("-" * 80)
-    report_lines.append("CLINICAL RECOMMENDATIONS")
-    report_lines.append("-" * 80)
-    
+    summary, notes = get_inference(icm, te, exp)[:2]
     recommendations = get_clinical_recommendations(icm, te, exp)
-    for rec in recommendations:
-        clean_rec = rec.replace('###', '').replace('**', '').replace('🎯', '').replace('🔬', '').replace('📋', '')
-        report_lines.append(clean_rec)
     
-    report_lines.append("")
-    report_lines.append("-" * 80)
-    report_lines.append("GRADING CRITERIA REFERENCE")
-    report_lines.append("-" * 80)
-    report_lines.append("")
-    report_lines.append("Inner Cell Mass (ICM): Grade 5 (Excellent) to Grade 1 (Poor)")
-    report_lines.append("Trophectoderm (TE): Grade 5 (Excellent) to Grade 1 (Poor)")
-    report_lines.append("Expansion (EXP): Grade 5 (Hatching) to Grade 1 (Early)")
-    report_lines.append("")
-    report_lines.append("=" * 80)
-    report_lines.append("DISCLAIMER: AI-assisted analysis. Requires professional validation.")
-    report_lines.append("=" * 80)
+    return "\n".join([
+        GRADING_SECTION,
+        f"Inner Cell Mass (ICM): {icm}/5 {STAR_BAR[icm]}",
+        f"Trophectoderm (TE): {te}/5 {STAR_BAR[te]}",
+        f"Expansion Grade (EXP): {exp}/5 {STAR_BAR[exp]}",
+        "",
+        f"Quality Score: {metrics['quality_score']}",
+        f"Success Probability: {metrics['success_probability']}",
+        f"Development Stage: {metrics['development_stage']}",
+        f"Transfer Priority: {metrics['transfer_priority']}",
+        "",
+        ANALYSIS_SECTION,
+        summary.translate(_SUMMARY_TRANS),
+        "",
+        *(note.translate(_NOTE_TRANS) for note in notes),
+        "",
+        RECOMMENDATIONS_SECTION,
+        *(rec.translate(_REC_TRANS) for rec in recommendations),
+    ])
+
+
+def generate_text_report(icm, te, exp, patient_data, now=None):
+    now = now or datetime.now()
+    sections = (
+        REPORT_HEADER,
+        f"Report Generated: {now.strftime('%B %d, %Y at %I:%M %p')}",
+        f"Report ID: {now.strftime('%Y%m%d-%H%M%S')}",
+        "System Version: v2.0",
+        "",
+        *_patient_section(patient_data),
+        "",
+        _results_section(icm, te, exp),
+    )
     
-    return "\n".join(report_lines)
+    buf = io.StringIO()
+    buf.writelines(f"{section}\n" for section in sections)
+    buf.write(REPORT_FOOTER)
+    return buf.getvalue()
 
 
 def save_to_history(analysis_data):
-    st.session_state.history.insert(0, analysis_data)
-    if len(st.session_state.history) > 100:
-        st.session_state.history = st.session_state.history[:100]
+    # Lowercased patient fields, built once so History search is a substring test
+    analysis_data['_search_blob'] = ' '.join(str(v) for v in analysis_data['patient_data'].values() if v is not None).lower()
+    st.session_state.history.appendleft(analysis_data)
+    
+    # Newest-first grade columns, kept in step with history for vectorized stats
+    icm, te, exp = analysis_data['icm'], analysis_data['te'], analysis_data['exp']
+    row = np.array([(icm, te, exp, icm + te + exp)], dtype=HISTORY_DTYPE)
+    st.session_state.history_arr = np.concatenate([row, st.session_state.history_arr[:MAX_HISTORY - 1]])
+
+
+def clear_history():
+    st.session_state.history.clear()
+    st.session_state.history_arr = np.empty(0, dtype=HISTORY_DTYPE)
 
 
 # Custom CSS
-st.markdown("""
+STATIC_CSS = """
     <style>
+    .metric-row {
+        display: grid;
+        grid-template-columns: repeat(auto-fit, minmax(160px, 1fr));
+        gap: 1rem;
+    }
+    
     .metric-card {
         background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
         padding: 25px;
@@ -288,53 +396,200 @@ st.markdown("""
         margin: 20px 0;
     }
     </style>
-""", unsafe_allow_html=True)
+"""
 
 
 # Background
-def add_bg(image_file):
-    try:
-        with open(image_file, "rb") as f:
-            data = f.read()
-        encoded = base64.b64encode(data).decode()
-        st.markdown(
-            f"""
+@st.cache_data
+def _encoded_asset(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode()
+
+
+@st.cache_data
+def _data_uri(path):
+    mime = mimetypes.guess_type(path)[0] or "image/png"
+    return f"data:{mime};base64,{_encoded_asset(path)}"
+
+
+BG_CSS_TEMPLATE = """
             <style>
                 .stApp {{
-                    background-image: url("data:image/png;base64,{encoded}");
+                    background-image: url("{uri}");
                     background-size: cover;
                     background-position: center;
                     background-attachment: fixed;
                 }}
             </style>
-            """,
-            unsafe_allow_html=True
-        )
+            """
+
+LOGO_HTML_TEMPLATE = """
+            <div style='position: fixed; right: 25px; bottom: 25px; z-index: 9999;'>
+                <img src='{uri}' style='width: 150px; opacity: 0.9; border-radius: 10px;'>
+            </div>
+            """
+
+
+def background_css(image_file):
+    try:
+        return BG_CSS_TEMPLATE.format(uri=_data_uri(image_file))
     except:
-        pass
+        return ""
 
-add_bg("background 2.jpg")
+
+@st.cache_data
+def _css():
+    return STATIC_CSS + background_css("background 2.jpg")
+
+st.markdown(_css(), unsafe_allow_html=True)
 
 
 # Load model
 @st.cache_resource
-def load_model():
-    return tf.keras.models.load_model("embryo_output_model.keras")
-
-model = load_model()
+def configure_devices():
+    gpus = tf.config.list_physical_devices("GPU")
+    for gpu in gpus:
+        tf.config.experimental.set_memory_growth(gpu, True)
+    return bool(gpus)
+
+USE_GPU = configure_devices()
+
+
+# Cached per model file mtime, so replacing the .keras file reloads without a restart
+@st.cache_resource(max_entries=1)
+def load_model(mtime):
+    m = tf.keras.models.load_model(MODEL_PATH)
+    m(tf.zeros((1, IMG_SIZE, IMG_SIZE, 3)), training=False)  # warm-up trace
+    return m
+
+@st.cache_resource(max_entries=1)
+def load_infer(_model, mtime):
+    @tf.function(input_signature=[tf.TensorSpec((1, IMG_SIZE, IMG_SIZE, 3), tf.uint8)])
+    def infer(x):
+        # Takes raw uint8 pixels: scaling happens in-graph, and grades (argmax + 1)
+        # are computed in-graph as one (3,) tensor of ICM, TE, EXP
+        x = tf.cast(x, tf.float32) * (1.0 / 255.0)
+        # Heads are matched by name: the saved model lists its outputs as exp, icm, te
+        heads = dict(zip(_model.output_names, _model(x, training=False)))
+        return tf.argmax(tf.stack([heads["icm"][0], heads["te"][0], heads["exp"][0]]), axis=1) + 1
+    infer(tf.zeros((1, IMG_SIZE, IMG_SIZE, 3), tf.uint8))  # trace once
+    return infer
+
+
+def _tflite_runner(**source):
+    # Models converted from a concrete function carry no SignatureDef, so address
+    # the single input and output tensors directly
+    interpreter = tf.lite.Interpreter(**source, num_threads=os.cpu_count())
+    interpreter.allocate_tensors()
+    input_index = interpreter.get_input_details()[0]["index"]
+    output_index = interpreter.get_output_details()[0]["index"]
+
+    def run(x):
+        interpreter.set_tensor(input_index, x)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    run(np.zeros((1, IMG_SIZE, IMG_SIZE, 3), np.uint8))  # warm up
+    return run
+
+
+def _convert_tflite(mtime):
+    model = load_model(mtime)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [load_infer(model, mtime).get_concrete_function()], model
+    )
+    # Float weights: int8 quantization stays off until its grades are checked against Keras
+    content = converter.convert()
+    
+    # Write to a temp file and rename, so an interrupted write never leaves a truncated cache
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(TFLITE_PATH)), suffix=".tflite")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600; match a plain open()
+        os.replace(tmp_path, TFLITE_PATH)
+    except OSError:
+        # Read-only or full disk: serve from memory and convert again next start
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return content
+
+
+@st.cache_resource(max_entries=1)
+def load_tflite(mtime):
+    # Reuse the converted model from a previous run unless the .keras file is newer,
+    # which skips building the Keras model at all. It is read into memory rather than
+    # passed as model_path: model_content is verified as a flatbuffer and raises on a
+    # damaged file, while the memory-mapped model_path load crashes the process
+    if os.path.exists(TFLITE_PATH) and os.path.getmtime(TFLITE_PATH) >= mtime:
+        try:
+            with open(TFLITE_PATH, "rb") as f:
+                return _tflite_runner(model_content=f.read())
+        except Exception:
+            # Unreadable cache file: discard it and convert again
+            try:
+                os.remove(TFLITE_PATH)
+            except OSError:
+                pass
+    return _tflite_runner(model_content=_convert_tflite(mtime))
+
+# TFLite runs on CPU only; with a GPU the traced graph is faster
+MODEL_MTIME = os.path.getmtime(MODEL_PATH)
+infer = load_infer(load_model(MODEL_MTIME), MODEL_MTIME) if USE_GPU else None
+runner = None if USE_GPU else load_tflite(MODEL_MTIME)
+
+
+# Upload decoding
+def decode_upload(data):
+    # Full-resolution OpenCV decode, as the model was used with: it applies EXIF
+    # orientation and scales 16-bit images to 8 bits
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
 
 # Prediction function
-def predict(img):
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = cv2.resize(img, (IMG_SIZE, IMG_SIZE))
-    x = np.expand_dims(img / 255.0, axis=0)
-    icm, te, exp = model.predict(x, verbose=0)
-    return (
-        int(np.argmax(icm[0]) + 1),
-        int(np.argmax(te[0]) + 1),
-        int(np.argmax(exp[0]) + 1)
-    )
+def prepare_image(img):
+    # Default INTER_LINEAR, the resampling the model's grades were produced with
+    return cv2.resize(img, (IMG_SIZE, IMG_SIZE))
+
+
+def encode_preview(img):
+    img = Image.fromarray(img)
+    img.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=85)
+    return out.getvalue()
+
+
+@st.cache_resource
+def input_buffer():
+    # Shared by all sessions, so fills and invocations are serialized by the lock
+    return np.empty((1, IMG_SIZE, IMG_SIZE, 3), np.uint8), threading.Lock()
+
+_INPUT_BUF, _INFER_LOCK = input_buffer()
+
+
+def predict(img_rs):
+    with _INFER_LOCK:
+        _INPUT_BUF[0] = img_rs
+        if USE_GPU:
+            with tf.device("/GPU:0"):
+                grades = infer(tf.identity(_INPUT_BUF))
+        else:
+            grades = runner(_INPUT_BUF)
+        icm, te, exp = np.asarray(grades).tolist()
+    return icm, te, exp
+
+
+# Keyed by the pixel content of the resized input and the model version, so
+# re-analyzing the same image (even re-uploaded) skips inference
+@st.cache_data(show_spinner=False, max_entries=256)
+def cached_predict(img_rs, model_mtime):
+    return predict(img_rs)
 
 
 # Sidebar
@@ -351,10 +606,188 @@ with st.sidebar:
     st.markdown("---")
     if st.session_state.history:
         st.metric("Total Analyses", len(st.session_state.history))
-        avg_quality = np.mean([h['avg_score'] for h in st.session_state.history])
+        avg_quality = st.session_state.history_arr['total'].mean() / 3
         st.metric("Avg Quality", f"{avg_quality:.2f}/5")
 
 
+# Analysis results (fragment: widgets inside rerun only this section)
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+
+@_fragment
+def analysis_section(small, patient_data, embryo_id):
+    if st.button("🔬 Analyze Embryo", type="primary", use_container_width=True):
+        with st.spinner("Analyzing..."):
+            analyzed_at = datetime.now()
+            timestamp = analyzed_at.strftime("%Y-%m-%d %H:%M:%S")
+            icm, te, exp = cached_predict(small, MODEL_MTIME)
+            avg_score = (icm + te + exp) / 3
+            metrics = calculate_success_metrics(icm, te, exp)
+            summary, _, quality_level = get_inference(icm, te, exp)
+            
+            if auto_save:
+                save_to_history({
+                    'timestamp': timestamp,
+                    'patient_data': patient_data,
+                    'icm': icm,
+                    'te': te,
+                    'exp': exp,
+                    'avg_score': avg_score
+                })
+            
+            st.success("✅ Analysis Complete!")
+            
+            # Results
+            st.markdown("## 📊 Grading Results")
+            
+            st.markdown(f"""
+                <div class='metric-row'>
+                    <div class='metric-card'>
+                        <h4>ICM</h4>
+                        <h1>{icm}/5</h1>
+                        <p>{STAR_BAR[icm]}</p>
+                    </div>
+                    <div class='metric-card'>
+                        <h4>TE</h4>
+                        <h1>{te}/5</h1>
+                        <p>{STAR_BAR[te]}</p>
+                    </div>
+                    <div class='metric-card'>
+                        <h4>EXP</h4>
+                        <h1>{exp}/5</h1>
+                        <p>{STAR_BAR[exp]}</p>
+                    </div>
+                    <div class='metric-card'>
+                        <h4>Average</h4>
+                        <h1>{avg_score:.2f}</h1>
+                        <p>Quality</p>
+                    </div>
+                </div>
+            """, unsafe_allow_html=True)
+            
+            # Success Metrics
+            if show_metrics:
+                st.markdown(f"""
+                    <div class='success-prob'>
+                        🎯 Success Probability: {metrics['success_probability']}
+                    </div>
+                """, unsafe_allow_html=True)
+                
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Stage", metrics['development_stage'])
+                col2.metric("Priority", metrics['transfer_priority'])
+                col3.metric("Score", metrics['quality_score'])
+            
+            # Clinical Analysis
+            st.markdown("## 🔬 Clinical Analysis")
+            
+            st.markdown(f"""
+                <div class='info-card'>
+                    <h3 style='color: #1F3C88; font-size: 20px;'>{md_bold_to_html(summary)}</h3>
+                </div>
+            """, unsafe_allow_html=True)
+            
+            st.markdown(analysis_notes_html(icm, te, exp), unsafe_allow_html=True)
+            
+            # Recommendations
+            if show_recommendations:
+                st.markdown("## 👨‍⚕️ Clinical Recommendations")
+                st.markdown(recommendation_html(icm, te, exp), unsafe_allow_html=True)
+            
+            # Download Reports
+            st.markdown("## 📥 Download Reports")
+            
+            file_date = analyzed_at.strftime('%Y%m%d')
+            col1, col2 = st.columns(2)
+            
+            with col1:
+                # Text Report
+                st.download_button(
+                    label="📄 Download Text Report",
+                    data=generate_text_report(icm, te, exp, patient_data, analyzed_at).encode("utf-8"),
+                    file_name=f"Report_{embryo_id}_{file_date}.txt",
+                    mime="text/plain",
+                    use_container_width=True
+                )
+            
+            with col2:
+                # JSON Export
+                json_data = {
+                    'timestamp': timestamp,
+                    'patient_data': patient_data,
+                    'results': {'icm': icm, 'te': te, 'exp': exp, 'avg': float(avg_score), 'quality': quality_level},
+                    'metrics': metrics
+                }
+                st.download_button(
+                    label="💾 Export JSON",
+                    data=json.dumps(json_data, indent=2),
+                    file_name=f"Data_{embryo_id}_{file_date}.json",
+                    mime="application/json",
+                    use_container_width=True
+                )
+
+
+# History list (fragment: search, filter and paging rerun only this section)
+@_fragment
+def history_section():
+    if not st.session_state.history:
+        st.info("📭 No history yet. Start analyzing embryos!")
+    else:
+        col1, col2 = st.columns([3, 2])
+        
+        with col1:
+            search = st.text_input("🔍 Search", placeholder="Patient ID, Embryo ID...")
+        
+        with col2:
+            quality_filter = st.selectbox("Filter", ["All", "Excellent (≥4)", "Moderate (3-4)", "Poor (<3)"])
+        
+        records = list(st.session_state.history)
+        totals = st.session_state.history_arr['total']
+        
+        # Quality filter as a mask over the grade sums: avg >= 4 is total >= 12, avg < 3 is total < 9
+        if "Excellent" in quality_filter:
+            mask = totals >= 12
+        elif "Moderate" in quality_filter:
+            mask = (totals >= 9) & (totals < 12)
+        elif "Poor" in quality_filter:
+            mask = totals < 9
+        else:
+            mask = np.ones(len(records), dtype=bool)
+        
+        if search:
+            search_lc = search.lower()
+            mask &= np.fromiter((search_lc in h['_search_blob'] for h in records), dtype=bool, count=len(records))
+        
+        filtered = [records[i] for i in np.flatnonzero(mask)]
+        
+        st.markdown(f"**Showing {len(filtered)} of {len(st.session_state.history)} records**")
+        
+        # Only the current page's expanders are built
+        pages = max(1, -(-len(filtered) // HISTORY_PAGE_SIZE))
+        page_no = st.number_input("Page", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+        start = (page_no - 1) * HISTORY_PAGE_SIZE
+        
+        for record in filtered[start:start + HISTORY_PAGE_SIZE]:
+            with st.expander(f"📋 {record['timestamp']} | {record['patient_data']['Embryo ID'] or 'N/A'} | {record['avg_score']:.2f}/5"):
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.markdown("**Patient Info:**")
+                    for key, value in record['patient_data'].items():
+                        if key != "Notes" and value is not None:
+                            st.write(f"• {key}: {value}")
+                
+                with col2:
+                    st.markdown("**Grades:**")
+                    st.write(f"• ICM: {record['icm']}/5 {STARS[record['icm']]}")
+                    st.write(f"• TE: {record['te']}/5 {STARS[record['te']]}")
+                    st.write(f"• EXP: {record['exp']}/5 {STARS[record['exp']]}")
+        
+        if st.button("🗑️ Clear All History"):
+            clear_history()
+            st.rerun()
+
+
 # Main Content
 if page == "🔬 Analysis":
     st.markdown("""
@@ -390,213 +823,36 @@ if page == "🔬 Analysis":
     uploaded = st.file_uploader("", type=["png", "jpg", "jpeg"], label_visibility="collapsed")
     
     if uploaded is not None:
-        file_bytes = np.frombuffer(uploaded.read(), np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+        # Decode, resize and encode once per upload; reruns reuse the session copies
+        if st.session_state.get('upload_id') != uploaded.file_id:
+            img = decode_upload(uploaded.getvalue())
+            st.session_state.upload_small = prepare_image(img)
+            st.session_state.upload_preview = encode_preview(img)
+            st.session_state.upload_id = uploaded.file_id
+        small = st.session_state.upload_small
         
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
-            st.image(img, caption="Uploaded Embryo Image", use_container_width=True)
+            st.image(st.session_state.upload_preview, caption="Uploaded Embryo Image", use_container_width=True)
         
-        if st.button("🔬 Analyze Embryo", type="primary", use_container_width=True):
-            with st.spinner("Analyzing..."):
-                icm, te, exp = predict(img)
-                
-                patient_data = {
-                    "Patient ID": patient_id or "N/A",
-                    "Age": patient_age,
-                    "Embryo ID": embryo_id or "N/A",
-                    "Day": cycle_day,
-                    "Collection Date": collection_date.strftime("%Y-%m-%d"),
-                    "Embryologist": doctor_name or "N/A",
-                    "Clinic": clinic_name or "N/A",
-                    "Media": culture_media or "N/A",
-                    "Notes": notes or "None"
-                }
-                
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                avg_score = (icm + te + exp) / 3
-                
-                if auto_save:
-                    save_to_history({
-                        'timestamp': timestamp,
-                        'patient_data': patient_data,
-                        'icm': icm,
-                        'te': te,
-                        'exp': exp,
-                        'avg_score': avg_score
-                    })
-                
-                st.success("✅ Analysis Complete!")
-                
-                # Results
-                st.markdown("## 📊 Grading Results")
-                
-                col1, col2, col3, col4 = st.columns(4)
-                
-                with col1:
-                    st.markdown(f"""
-                        <div class='metric-card'>
-                            <h4>ICM</h4>
-                            <h1>{icm}/5</h1>
-                            <p>{'⭐' * icm}{'☆' * (5-icm)}</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                
-                with col2:
-                    st.markdown(f"""
-                        <div class='metric-card'>
-                            <h4>TE</h4>
-                            <h1>{te}/5</h1>
-                            <p>{'⭐' * te}{'☆' * (5-te)}</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                
-                with col3:
-                    st.markdown(f"""
-                        <div class='metric-card'>
-                            <h4>EXP</h4>
-                            <h1>{exp}/5</h1>
-                            <p>{'⭐' * exp}{'☆' * (5-exp)}</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                
-                with col4:
-                    st.markdown(f"""
-                        <div class='metric-card'>
-                            <h4>Average</h4>
-                            <h1>{avg_score:.2f}</h1>
-                            <p>Quality</p>
-                        </div>
-                    """, unsafe_allow_html=True)
-                
-                # Success Metrics
-                if show_metrics:
-                    metrics = calculate_success_metrics(icm, te, exp)
-                    
-                    st.markdown(f"""
-                        <div class='success-prob'>
-                            🎯 Success Probability: {metrics['success_probability']}
-                        </div>
-                    """, unsafe_allow_html=True)
-                    
-                    col1, col2, col3 = st.columns(3)
-                    col1.metric("Stage", metrics['development_stage'])
-                    col2.metric("Priority", metrics['transfer_priority'])
-                    col3.metric("Score", metrics['quality_score'])
-                
-                # Clinical Analysis
-                st.markdown("## 🔬 Clinical Analysis")
-                summary, notes_list, quality_level = get_inference(icm, te, exp)
-                
-                st.markdown(f"""
-                    <div class='info-card'>
-                        <h3 style='color: #1F3C88; font-size: 20px;'>{summary}</h3>
-                    </div>
-                """, unsafe_allow_html=True)
-                
-                for note in notes_list:
-                    st.markdown(f"""
-                        <div class='analysis-note'>
-                            {note}
-                        </div>
-                    """, unsafe_allow_html=True)
-                
-                # Recommendations
-                if show_recommendations:
-                    st.markdown("## 👨‍⚕️ Clinical Recommendations")
-                    recommendations = get_clinical_recommendations(icm, te, exp)
-                    
-                    rec_html = "<div class='recommendation-box'>"
-                    for rec in recommendations:
-                        if rec.startswith('###'):
-                            clean_heading = rec.replace('###', '').strip()
-                            rec_html += f"<h4 style='color: #1F3C88; font-size: 18px; font-weight: 700; margin-top: 15px;'>{clean_heading}</h4>"
-                        else:
-                            rec_html += f"<p style='color: #2c3e50; font-size: 15px; line-height: 1.8; margin: 8px 0;'>{rec}</p>"
-                    rec_html += "</div>"
-                    
-                    st.markdown(rec_html, unsafe_allow_html=True)
-                
-                # Download Reports
-                st.markdown("## 📥 Download Reports")
-                
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    # Text Report
-                    text_report = generate_text_report(icm, te, exp, patient_data)
-                    st.download_button(
-                        label="📄 Download Text Report",
-                        data=text_report,
-                        file_name=f"Report_{embryo_id}_{datetime.now().strftime('%Y%m%d')}.txt",
-                        mime="text/plain",
-                        use_container_width=True
-                    )
-                
-                with col2:
-                    # JSON Export
-                    json_data = {
-                        'timestamp': timestamp,
-                        'patient_data': patient_data,
-                        'results': {'icm': icm, 'te': te, 'exp': exp, 'avg': float(avg_score), 'quality': quality_level},
-                        'metrics': metrics
-                    }
-                    st.download_button(
-                        label="💾 Export JSON",
-                        data=json.dumps(json_data, indent=2),
-                        file_name=f"Data_{embryo_id}_{datetime.now().strftime('%Y%m%d')}.json",
-                        mime="application/json",
-                        use_container_width=True
-                    )
+        # Empty fields are stored as None (null in the JSON export), keeping the key set fixed
+        patient_fields = (
+            ("Patient ID", patient_id),
+            ("Age", patient_age),
+            ("Embryo ID", embryo_id),
+            ("Day", cycle_day),
+            ("Collection Date", collection_date.strftime("%Y-%m-%d")),
+            ("Embryologist", doctor_name),
+            ("Clinic", clinic_name),
+            ("Media", culture_media),
+            ("Notes", notes),
+        )
+        patient_data = {key: value or None for key, value in patient_fields}
+        analysis_section(small, patient_data, embryo_id)
 
 elif page == "📜 History":
     st.markdown("## 📜 Analysis History")
-    
-    if not st.session_state.history:
-        st.info("📭 No history yet. Start analyzing embryos!")
-    else:
-        col1, col2 = st.columns([3, 2])
-        
-        with col1:
-            search = st.text_input("🔍 Search", placeholder="Patient ID, Embryo ID...")
-        
-        with col2:
-            quality_filter = st.selectbox("Filter", ["All", "Excellent (≥4)", "Moderate (3-4)", "Poor (<3)"])
-        
-        filtered = st.session_state.history.copy()
-        
-        if search:
-            filtered = [h for h in filtered if search.lower() in str(h['patient_data']).lower()]
-        
-        if quality_filter != "All":
-            if "Excellent" in quality_filter:
-                filtered = [h for h in filtered if h['avg_score'] >= 4.0]
-            elif "Moderate" in quality_filter:
-                filtered = [h for h in filtered if 3.0 <= h['avg_score'] < 4.0]
-            else:
-                filtered = [h for h in filtered if h['avg_score'] < 3.0]
-        
-        st.markdown(f"**Showing {len(filtered)} of {len(st.session_state.history)} records**")
-        
-        for idx, record in enumerate(filtered):
-            with st.expander(f"📋 {record['timestamp']} | {record['patient_data']['Embryo ID']} | {record['avg_score']:.2f}/5"):
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    st.markdown("**Patient Info:**")
-                    for key, value in record['patient_data'].items():
-                        if key != "Notes":
-                            st.write(f"• {key}: {value}")
-                
-                with col2:
-                    st.markdown("**Grades:**")
-                    st.write(f"• ICM: {record['icm']}/5 {'⭐' * record['icm']}")
-                    st.write(f"• TE: {record['te']}/5 {'⭐' * record['te']}")
-                    st.write(f"• EXP: {record['exp']}/5 {'⭐' * record['exp']}")
-        
-        if st.button("🗑️ Clear All History"):
-            st.session_state.history = []
-            st.rerun()
+    history_section()
 
 elif page == "📊 Statistics":
     st.markdown("## 📊 Statistics")
@@ -604,14 +860,14 @@ elif page == "📊 Statistics":
     if not st.session_state.history:
         st.info("No data yet")
     else:
-        total = len(st.session_state.history)
-        avg_icm = np.mean([h['icm'] for h in st.session_state.history])
-        avg_te = np.mean([h['te'] for h in st.session_state.history])
-        avg_exp = np.mean([h['exp'] for h in st.session_state.history])
+        arr = st.session_state.history_arr
+        total = len(arr)
+        avg_icm = arr['icm'].mean()
+        avg_te = arr['te'].mean()
+        avg_exp = arr['exp'].mean()
         
-        excellent = sum(1 for h in st.session_state.history if h['avg_score'] >= 4.0)
-        moderate = sum(1 for h in st.session_state.history if 3.0 <= h['avg_score'] < 4.0)
-        poor = sum(1 for h in st.session_state.history if h['avg_score'] < 3.0)
+        # Grade sums < 9 / 9-11 / >= 12 are the poor / moderate / excellent buckets (avg < 3 / 3-4 / >= 4)
+        poor, moderate, excellent = np.bincount(np.digitize(arr['total'], (9, 12)), minlength=3).tolist()
         
         col1, col2, col3, col4 = st.columns(4)
         col1.metric("Total", total)
@@ -652,16 +908,7 @@ else:  # About
 # Logo
 def add_logo():
     try:
-        with open("logo.png", "rb") as f:
-            encoded = base64.b64encode(f.read()).decode()
-        st.markdown(
-            f"""
-            <div style='position: fixed; right: 25px; bottom: 25px; z-index: 9999;'>
-                <img src='data:image/png;base64,{encoded}' style='width: 150px; opacity: 0.9; border-radius: 10px;'>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
+        st.markdown(LOGO_HTML_TEMPLATE.format(uri=_data_uri("logo.png")), unsafe_allow_html=True)
     except:
         pass
 
@@ -0,0 +1,68 @@
+"""Check that the app's CPU inference path grades images like the Keras model.
+
+Usage: python check_model.py [--int8] IMAGE [IMAGE ...]
+
+Imports app.py outside `streamlit run` (Streamlit's bare mode), which loads the
+model and converts/caches the TFLite file exactly as a CPU deploy does. Each
+image is then decoded and resized by the app and graded twice: by the TFLite
+runner and by the float Keras model (heads matched by name). Exits non-zero if
+any grade differs. With --int8, the images are graded by an in-memory
+dynamic-range int8 conversion instead of the app's float TFLite model, to check
+quantization before enabling it. Streamlit logs bare-mode warnings to stderr; the results go
+to stdout.
+"""
+import os
+import sys
+
+import numpy as np
+
+
+def keras_grades(model, img_rs):
+    outputs = model.predict(img_rs[np.newaxis] / 255.0, verbose=0)
+    heads = dict(zip(model.output_names, outputs))
+    return [int(np.argmax(heads[name][0]) + 1) for name in ("icm", "te", "exp")]
+
+
+def int8_runner(app, model):
+    tf = app.tf
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [app.load_infer(model, app.MODEL_MTIME).get_concrete_function()], model
+    )
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    return app._tflite_runner(model_content=converter.convert())
+
+
+def main(args):
+    int8 = "--int8" in args
+    paths = [a for a in args if a != "--int8"]
+    if not paths:
+        print(__doc__)
+        return 2
+    paths = [os.path.abspath(p) for p in paths]
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # app.py loads its assets by relative path
+
+    import app
+
+    model = app.load_model(app.MODEL_MTIME)
+    if int8:
+        runner = int8_runner(app, model)
+    else:
+        runner = app.runner or app.load_tflite(app.MODEL_MTIME)
+
+    mismatches = 0
+    for path in paths:
+        with open(path, "rb") as f:
+            img_rs = app.prepare_image(app.decode_upload(f.read()))
+        app._INPUT_BUF[0] = img_rs
+        tflite = np.asarray(runner(app._INPUT_BUF)).tolist()
+        keras = keras_grades(model, img_rs)
+        ok = tflite == keras
+        mismatches += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {path}: tflite={tflite} keras={keras}")
+
+    print(f"{len(paths) - mismatches}/{len(paths)} images agree")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))